@@ -1,3 +1,4 @@
+from pydantic import field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List, Optional
 
@@ -15,8 +16,25 @@ class Settings(BaseSettings):
     API_MASTER_KEY: Optional[str] = None
     
     API_REQUEST_TIMEOUT: int = 180
+    # 执行同步 cloudscraper 请求的线程池大小，决定回退模式下的最大上游并发数
+    THREAD_POOL_MAX_WORKERS: int = 64
     NGINX_PORT: int = 8088
     SESSION_CACHE_TTL: int = 3600
+    # 后台清理过期会话的间隔（秒）
+    SESSION_SWEEP_INTERVAL: int = 60
+    # 单个会话最多保留的历史消息条数（用户与模型消息各计一条，须为不小于 2 的偶数）
+    SESSION_MAX_MESSAGES: int = 64
+    # 发送给上游的上下文最大字符数（上游限制为 1000，此处预留余量）
+    CONTEXT_MAX_LENGTH: int = 900
+    # nonce 的有效期（秒），超时后在后台主动刷新；设为 0 则仅在上游报错时刷新
+    NONCE_TTL: int = 3600
+    # nonce 刷新失败后，距离下一次尝试的间隔（秒）
+    NONCE_RETRY_INTERVAL: int = 60
+
+    # 伪流式输出：每个 SSE 块包含的字符数，以及块与块之间的间隔（秒）。
+    # 上游为一次性返回，默认不再人为延迟，由网络自行控制节奏
+    PSEUDO_STREAM_CHUNK_SIZE: int = 12
+    PSEUDO_STREAM_DELAY: float = 0.0
 
     KNOWN_MODELS: List[str] = ["kimi-k2-instruct-0905", "kimi-k2-instruct"]
     DEFAULT_MODEL: str = "kimi-k2-instruct-0905"
@@ -24,4 +42,12 @@ class Settings(BaseSettings):
     UPSTREAM_URL: str = "https://kimi-ai.chat/wp-admin/admin-ajax.php"
     CHAT_PAGE_URL: str = "https://kimi-ai.chat/chat/"
 
+    @field_validator("SESSION_MAX_MESSAGES")
+    @classmethod
+    def _check_session_max_messages(cls, value: int) -> int:
+        # 历史按 (用户, 模型) 成对写入与截断，奇数或 0 会使轮次错位或使 history_len 失准
+        if value < 2 or value % 2:
+            raise ValueError("SESSION_MAX_MESSAGES 必须是不小于 2 的偶数。")
+        return value
+
 settings = Settings()
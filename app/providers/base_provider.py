@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from typing import Dict, Any
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, Response
 
 class BaseProvider(ABC):
     @abstractmethod
@@ -8,5 +8,5 @@ class BaseProvider(ABC):
         pass
 
     @abstractmethod
-    async def get_models(self) -> JSONResponse:
+    async def get_models(self) -> Response:
         pass
@@ -1,48 +1,138 @@
-import json
+import os
 import time
 import uuid
-import random
-import string
 import re
 import asyncio
-from typing import Dict, Any, AsyncGenerator, Optional, List
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, AsyncGenerator, Optional
 
 import cloudscraper
+import httpx
+import orjson
 from fastapi import HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from cachetools import TTLCache
+from fastapi.responses import StreamingResponse, Response
+from cachetools import LRUCache
 from loguru import logger
+from urllib3.util.retry import Retry
 
 from app.core.config import settings
 from app.providers.base_provider import BaseProvider
-from app.utils.sse_utils import create_sse_data, create_chat_completion_chunk, DONE_CHUNK
+from app.utils.sse_utils import create_sse_data, create_chat_completion_chunk, create_content_chunk_affixes, DONE_CHUNK
+
+# 预编译 nonce 提取正则，直接作用于原始字节，避免每次刷新重复编译与整页解码。
+# kimi_ajax 是一个扁平对象，用 [^}]* 代替惰性 .*?，在畸形 HTML 上也不会回溯。
+KIMI_AJAX_RE = re.compile(rb'var kimi_ajax = (\{[^}]*\});')
+
+# 对外模型名称 -> 上游接受的模型名称
+UPSTREAM_MODEL_MAP: Dict[str, str] = {
+    "kimi-k2-instruct-0905": "moonshotai/Kimi-K2-Instruct-0905",
+    "kimi-k2-instruct": "moonshotai/Kimi-K2-Instruct",
+}
+
+def _new_session_id() -> str:
+    """生成上游所需格式的 session_id: session_<毫秒时间戳>_<随机串>。"""
+    return f"session_{int(time.time() * 1000)}_{os.urandom(5).hex()}"
 
 class KimiAIProvider(BaseProvider):
     def __init__(self):
         self.scraper = cloudscraper.create_scraper()
-        # 缓存结构: { "user_key": {"kimi_session_id": "...", "messages": [...] } }
-        self.session_cache = TTLCache(maxsize=1024, ttl=settings.SESSION_CACHE_TTL)
+        # 为回退路径显式配置连接池与重试，使线程池中的并发请求复用已建立的 TLS 连接。
+        # 必须继续使用 cloudscraper 的 CipherSuiteAdapter 并沿用其密码套件、ECDH 曲线与 ssl_context：
+        # 换成普通 HTTPAdapter 会暴露默认的 Python TLS 指纹，恰好触发 Cloudflare 质询。
+        # 不对 503 重试：Cloudflare 质询页面以 503 返回，需交由 cloudscraper 处理
+        adapter = cloudscraper.CipherSuiteAdapter(
+            cipherSuite=self.scraper.cipherSuite,
+            ecdhCurve=self.scraper.ecdhCurve,
+            server_hostname=self.scraper.server_hostname,
+            source_address=self.scraper.source_address,
+            ssl_context=self.scraper.get_adapter("https://").ssl_context,
+            pool_connections=20,
+            pool_maxsize=100,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 504])
+        )
+        self.scraper.mount("https://", adapter)
+        self.scraper.headers.update({"Connection": "keep-alive"})
+        # 复用连接池的异步客户端，避免阻塞事件循环并省去重复的 TLS 握手
+        self.client = httpx.AsyncClient(
+            timeout=settings.API_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            headers={"User-Agent": self.scraper.headers.get("User-Agent", "")},
+            follow_redirects=True
+        )
+        # 一旦遇到 Cloudflare JS 质询，后续请求改走 cloudscraper
+        self._use_scraper = False
+        # 缓存结构: { "user_key": {"kimi_session_id": "...", "messages": deque, "history_lines": deque, "history_len": int, "last_access": float } }
+        # 过期会话由后台任务批量清理，避免 TTLCache 在每次读写时执行过期扫描
+        self.session_cache = LRUCache(maxsize=1024)
+        self._session_sweeper_task: Optional[asyncio.Task] = None
+        self._session_locks = weakref.WeakValueDictionary()
         self._nonce: Optional[str] = None
+        self._nonce_fetched_at: float = 0.0
         self._nonce_lock = asyncio.Lock()
+        self._nonce_refresh_task: Optional[asyncio.Task] = None
+        self._models_response_bytes: bytes = b""
 
     async def initialize(self):
         """在服务启动时预取一次 nonce。"""
+        # cloudscraper 为同步库，经 asyncio.to_thread 执行；线程池大小需与预期并发量匹配
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=settings.THREAD_POOL_MAX_WORKERS))
+        # 模型列表在进程生命周期内不变，启动时序列化一次即可
+        created = int(time.time())
+        self._models_response_bytes = orjson.dumps({
+            "object": "list",
+            "data": [
+                {"id": name, "object": "model", "created": created, "owned_by": "lzA6"}
+                for name in settings.KNOWN_MODELS
+            ]
+        })
         logger.info("正在初始化 KimiAIProvider，首次获取 nonce...")
         await self._get_nonce()
+        self._session_sweeper_task = asyncio.create_task(self._ttl_sweeper())
+
+    async def shutdown(self):
+        """在服务关闭时释放底层连接。"""
+        for task in (self._nonce_refresh_task, self._session_sweeper_task):
+            if task is not None:
+                task.cancel()
+        await self.client.aclose()
+        self.scraper.close()
+
+    @staticmethod
+    def _is_cloudflare_challenge(response: httpx.Response) -> bool:
+        """判断响应是否为 Cloudflare 的 JS 质询页面。"""
+        if response.headers.get("cf-mitigated") == "challenge":
+            return True
+        return response.status_code in (403, 503) and "cloudflare" in response.headers.get("server", "").lower()
+
+    async def _request(self, method: str, url: str, **kwargs):
+        """
+        发送上游请求。优先使用异步 httpx 客户端；若被 Cloudflare 质询拦截，
+        则回退到在线程池中执行的 cloudscraper，以免阻塞事件循环。
+        """
+        if not self._use_scraper:
+            response = await self.client.request(method, url, **kwargs)
+            if not self._is_cloudflare_challenge(response):
+                return response
+            logger.warning("检测到 Cloudflare 质询，后续请求将回退至 cloudscraper。")
+            self._use_scraper = True
+        return await asyncio.to_thread(self.scraper.request, method, url, **kwargs)
 
     async def _fetch_nonce(self) -> str:
         """从聊天页面抓取动态的 nonce 值。"""
         try:
             logger.info("正在从上游页面抓取新的 nonce...")
-            response = self.scraper.get(settings.CHAT_PAGE_URL, timeout=20)
+            response = await self._request("GET", settings.CHAT_PAGE_URL, timeout=20)
             response.raise_for_status()
-            html_content = response.text
+            html_bytes = response.content
 
-            match = re.search(r'var kimi_ajax = ({.*?});', html_content)
+            match = KIMI_AJAX_RE.search(html_bytes)
             if not match:
                 raise ValueError("在页面 HTML 中未找到 'kimi_ajax' JS 变量。")
 
-            ajax_data = json.loads(match.group(1))
+            ajax_data = orjson.loads(match.group(1))
             nonce = ajax_data.get("nonce")
             if not nonce:
                 raise ValueError("'kimi_ajax' 对象中缺少 'nonce' 字段。")
@@ -55,60 +145,131 @@ class KimiAIProvider(BaseProvider):
 
     async def _get_nonce(self, force_refresh: bool = False) -> str:
         """获取并缓存 nonce，处理并发请求和刷新逻辑。"""
+        # 快速路径：nonce 已存在时无需加锁，过期则交由后台任务刷新
+        if not force_refresh and self._nonce is not None:
+            if settings.NONCE_TTL > 0 and time.monotonic() - self._nonce_fetched_at > settings.NONCE_TTL:
+                self._schedule_nonce_refresh()
+            return self._nonce
+
+        fetched_at = self._nonce_fetched_at
         async with self._nonce_lock:
-            if self._nonce is None or force_refresh:
+            # 等锁期间若其他协程已完成（或刚尝试过）刷新，直接沿用结果，避免连续重复抓取页面
+            if self._nonce is not None and (not force_refresh or self._nonce_fetched_at != fetched_at):
+                return self._nonce
+            try:
                 self._nonce = await self._fetch_nonce()
+            except Exception:
+                # 刷新失败时保留旧 nonce，并将下一次按 TTL 的刷新推迟 NONCE_RETRY_INTERVAL 秒，
+                # 避免上游故障期间每个请求都触发一次抓取
+                if self._nonce is not None:
+                    self._nonce_fetched_at = time.monotonic() - settings.NONCE_TTL + settings.NONCE_RETRY_INTERVAL
+                raise
+            self._nonce_fetched_at = time.monotonic()
             return self._nonce
 
+    def _schedule_nonce_refresh(self):
+        """在后台刷新 nonce，确保同一时间只有一个刷新任务。"""
+        if self._nonce_refresh_task is None or self._nonce_refresh_task.done():
+            logger.info("nonce 已超过有效期，正在后台刷新...")
+            self._nonce_refresh_task = asyncio.create_task(self._refresh_nonce_in_background())
+
+    async def _refresh_nonce_in_background(self):
+        try:
+            await self._get_nonce(force_refresh=True)
+        except Exception as e:
+            # 保留旧的 nonce，NONCE_RETRY_INTERVAL 秒后再次尝试刷新
+            logger.warning(f"后台刷新 nonce 失败: {e}")
+
+    async def _ttl_sweeper(self):
+        """定期批量清理超过 SESSION_CACHE_TTL 未活动的会话。"""
+        while True:
+            await asyncio.sleep(settings.SESSION_SWEEP_INTERVAL)
+            deadline = time.monotonic() - settings.SESSION_CACHE_TTL
+            # 读取会刷新 LRU 顺序，因此按最近访问时间依次处理，使存活会话恢复原有顺序
+            entries = sorted(list(self.session_cache.items()), key=lambda item: item[1]["last_access"])
+            expired = 0
+            for key, session in entries:
+                if session["last_access"] < deadline:
+                    self.session_cache.pop(key, None)
+                    expired += 1
+                else:
+                    self.session_cache.get(key)
+            if expired:
+                logger.info(f"已清理 {expired} 个过期会话。")
+
+    def _get_session_lock(self, user_key: str) -> asyncio.Lock:
+        """获取用户的会话锁，仅在不存在时创建；锁以弱引用保存，无请求持有时自动回收。"""
+        lock = self._session_locks.get(user_key)
+        if lock is None:
+            lock = self._session_locks[user_key] = asyncio.Lock()
+        return lock
+
     def _get_or_create_session(self, user_key: str) -> Dict[str, Any]:
         """为用户获取或创建一个新的会话对象。"""
-        if user_key in self.session_cache:
-            return self.session_cache[user_key]
+        now = time.monotonic()
+        session = self.session_cache.get(user_key)
+        # 惰性过期检查：在清理任务运行前，已过期的会话同样视为不存在
+        if session is not None and now - session["last_access"] <= settings.SESSION_CACHE_TTL:
+            session["last_access"] = now
+            return session
         
-        timestamp = int(time.time() * 1000)
-        random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=9))
-        new_session_id = f"session_{timestamp}_{random_str}"
+        new_session_id = _new_session_id()
         
         new_session = {
             "kimi_session_id": new_session_id,
-            "messages": []
+            # 以 maxlen 作为硬上限，防止长时间运行的会话无限占用内存
+            "messages": deque(maxlen=settings.SESSION_MAX_MESSAGES),
+            # 预先格式化好的 "角色: 内容" 行，及其总长度（每行额外计入一个换行符）
+            "history_lines": deque(maxlen=settings.SESSION_MAX_MESSAGES),
+            "history_len": 0,
+            "last_access": now
         }
         self.session_cache[user_key] = new_session
         logger.info(f"为用户 '{user_key}' 创建了新的会话: {new_session_id}")
         return new_session
 
-    def _build_contextual_prompt(self, history: List[Dict[str, str]], new_message: str) -> str:
+    def _append_to_history(self, session_data: Dict[str, Any], message: Dict[str, str]):
+        """将一条消息追加到会话历史，同时增量维护格式化行及其总长度。"""
+        role = "用户" if message.get("role") == "user" else "模型"
+        line = f"{role}: {message.get('content', '')}"
+        # 达到上限时显式移除最早的消息，以便同步扣减 history_len
+        while session_data["messages"] and len(session_data["messages"]) >= session_data["messages"].maxlen:
+            self._pop_oldest_history(session_data)
+        session_data["messages"].append(message)
+        session_data["history_lines"].append(line)
+        session_data["history_len"] += len(line) + 1
+
+    def _pop_oldest_history(self, session_data: Dict[str, Any]):
+        """移除会话历史中最早的一条消息，并同步扣减其长度。"""
+        session_data["messages"].popleft()
+        line = session_data["history_lines"].popleft()
+        session_data["history_len"] -= len(line) + 1
+
+    def _build_contextual_prompt(self, session_data: Dict[str, Any], new_message: str) -> str:
         """
         将历史记录和新消息拼接成一个单一的字符串，并根据需要截断以满足1000字符的限制。
         """
-        # 格式化历史记录为 "角色: 内容" 的形式
-        history_lines = []
-        for msg in history:
-            role = "用户" if msg.get("role") == "user" else "模型"
-            history_lines.append(f"{role}: {msg.get('content', '')}")
-        
+        history_lines = session_data["history_lines"]
+        new_line = f"用户: {new_message}"
+        if not history_lines:
+            return new_line.strip()
+
+        # 拼接后长度 = (history_len - 1) + len("\n") + len(new_line)，
+        # 因此历史部分的长度预算只需在循环外计算一次
+        history_budget = settings.CONTEXT_MAX_LENGTH - len(new_line)
+        if session_data["history_len"] > history_budget:
+            logger.warning(f"上下文超长 ({session_data['history_len'] + len(new_line)} > {settings.CONTEXT_MAX_LENGTH})，正在从头部截断...")
+            # 智能截断逻辑：从头开始移除一轮对话（用户+模型），仅扣减长度，不重建字符串
+            while history_lines and session_data["history_len"] > history_budget:
+                # 移除最早的一条用户消息
+                self._pop_oldest_history(session_data)
+                # 如果还有消息，再移除一条对应的模型消息
+                if history_lines:
+                    self._pop_oldest_history(session_data)
+
+        # 仅在截断完成后拼接一次
         history_str = "\n".join(history_lines)
-        
-        # 初始完整上下文
-        full_prompt = f"{history_str}\n用户: {new_message}".strip()
-
-        # 智能截断逻辑：如果超出长度，从头开始移除一轮对话（用户+模型）
-        while len(full_prompt) > settings.CONTEXT_MAX_LENGTH and history:
-            logger.warning(f"上下文超长 ({len(full_prompt)} > {settings.CONTEXT_MAX_LENGTH})，正在从头部截断...")
-            # 移除最早的一条用户消息
-            history.pop(0) 
-            # 如果还有消息，再移除一条对应的模型消息
-            if history:
-                history.pop(0)
-            
-            history_lines = []
-            for msg in history:
-                role = "用户" if msg.get("role") == "user" else "模型"
-                history_lines.append(f"{role}: {msg.get('content', '')}")
-            history_str = "\n".join(history_lines)
-            full_prompt = f"{history_str}\n用户: {new_message}".strip()
-        
-        return full_prompt
+        return f"{history_str}\n{new_line}".strip()
 
     async def chat_completion(self, request_data: Dict[str, Any]) -> StreamingResponse:
         user_key = request_data.get("user")
@@ -121,64 +282,45 @@ class KimiAIProvider(BaseProvider):
         
         # 根据是否存在 user_key 决定工作模式
         if user_key:
-            # --- 有状态模式 ---
             logger.info(f"检测到 'user' 字段，进入有状态模式。用户: {user_key}")
-            session_data = self._get_or_create_session(user_key)
-            prompt_to_send = self._build_contextual_prompt(session_data["messages"], current_user_message["content"])
-            kimi_session_id = session_data["kimi_session_id"]
         else:
-            # --- 无状态模式 ---
             logger.info("未检测到 'user' 字段，进入无状态模式。")
-            session_data = None # 无状态模式下没有会话数据
-            prompt_to_send = current_user_message["content"]
-            # 为无状态请求生成一次性的 session_id
-            timestamp = int(time.time() * 1000)
-            random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=9))
-            kimi_session_id = f"session_{timestamp}_{random_str}"
 
         async def stream_generator() -> AsyncGenerator[bytes, None]:
             request_id = f"chatcmpl-{uuid.uuid4()}"
             model = request_data.get("model", settings.DEFAULT_MODEL)
             
             try:
-                nonce = await self._get_nonce()
-                payload = self._prepare_payload(prompt_to_send, model, kimi_session_id, nonce)
-                
-                logger.info(f"向上游发送请求, Session ID: {kimi_session_id}, 模型: {payload['model']}")
-                logger.debug(f"发送的完整 Prompt: {prompt_to_send}")
-                
-                response = self.scraper.post(settings.UPSTREAM_URL, data=payload, timeout=settings.API_REQUEST_TIMEOUT)
-                response.raise_for_status()
-                
-                response_data = response.json()
-                if not response_data.get("success"):
-                    error_message = response_data.get("data", "未知错误")
-                    logger.warning(f"上游请求失败: {error_message}。可能 nonce 失效，正在尝试刷新并重试...")
-                    
-                    nonce = await self._get_nonce(force_refresh=True)
-                    payload['nonce'] = nonce
-                    
-                    response = self.scraper.post(settings.UPSTREAM_URL, data=payload, timeout=settings.API_REQUEST_TIMEOUT)
-                    response.raise_for_status()
-                    response_data = response.json()
-
-                    if not response_data.get("success"):
-                         raise HTTPException(status_code=502, detail=f"重试后上游请求依然失败: {response_data.get('data', '未知错误')}")
-
-                assistant_response_content = response_data.get("data", {}).get("message", "")
-                
-                # 如果是有状态模式，则更新服务端会话历史
-                if session_data:
-                    session_data["messages"].append(current_user_message)
-                    session_data["messages"].append({"role": "assistant", "content": assistant_response_content})
-                    self.session_cache[user_key] = session_data
-                    logger.info(f"会话 '{user_key}' 上下文已更新。")
-
-                # 应用【模式：伪流式生成】
-                for char in assistant_response_content:
-                    chunk = create_chat_completion_chunk(request_id, model, char)
-                    yield create_sse_data(chunk)
-                    await asyncio.sleep(0.02)
+                # 上游一次性返回完整 JSON，无法逐 token 转发；先立即发送角色块，
+                # 使客户端在等待上游期间即可收到首字节，而不必等待完整往返
+                yield create_sse_data(create_chat_completion_chunk(request_id, model, "", role="assistant"))
+
+                if user_key:
+                    # --- 有状态模式 ---
+                    # 读取历史、构建 Prompt、请求上游、写回历史需作为一个整体按用户串行执行，
+                    # 否则同一用户的并发请求会基于同一份历史构建 Prompt，并交错写入彼此的对话轮次
+                    async with self._get_session_lock(user_key):
+                        session_data = self._get_or_create_session(user_key)
+                        prompt_to_send = self._build_contextual_prompt(session_data, current_user_message["content"])
+                        assistant_response_content = await self._send_message(prompt_to_send, model, session_data["kimi_session_id"])
+
+                        self._append_to_history(session_data, current_user_message)
+                        self._append_to_history(session_data, {"role": "assistant", "content": assistant_response_content})
+                        logger.info(f"会话 '{user_key}' 上下文已更新。")
+                else:
+                    # --- 无状态模式 ---
+                    # 为无状态请求生成一次性的 session_id
+                    assistant_response_content = await self._send_message(current_user_message["content"], model, _new_session_id())
+
+                # 应用【模式：伪流式生成】按固定字符数分块输出，而非逐字输出；
+                # 块中不变的部分只生成一次，每块仅序列化内容字符串
+                chunk_size = max(1, settings.PSEUDO_STREAM_CHUNK_SIZE)
+                chunk_prefix, chunk_suffix = create_content_chunk_affixes(request_id, model)
+                for i in range(0, len(assistant_response_content), chunk_size):
+                    piece = assistant_response_content[i:i + chunk_size]
+                    yield chunk_prefix + orjson.dumps(piece) + chunk_suffix
+                    if settings.PSEUDO_STREAM_DELAY > 0:
+                        await asyncio.sleep(settings.PSEUDO_STREAM_DELAY)
 
                 final_chunk = create_chat_completion_chunk(request_id, model, "", "stop")
                 yield create_sse_data(final_chunk)
@@ -193,13 +335,38 @@ class KimiAIProvider(BaseProvider):
 
         return StreamingResponse(stream_generator(), media_type="text/event-stream")
 
+    async def _send_message(self, prompt: str, model: str, session_id: str) -> str:
+        """向上游发送消息并返回模型回复；若上游返回失败，则刷新 nonce 后重试一次。"""
+        nonce = await self._get_nonce()
+        payload = self._prepare_payload(prompt, model, session_id, nonce)
+        
+        logger.info(f"向上游发送请求, Session ID: {session_id}, 模型: {payload['model']}")
+        logger.debug(f"发送的完整 Prompt: {prompt}")
+        
+        response = await self._request("POST", settings.UPSTREAM_URL, data=payload, timeout=settings.API_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        
+        response_data = orjson.loads(response.content)
+        if not response_data.get("success"):
+            error_message = response_data.get("data", "未知错误")
+            logger.warning(f"上游请求失败: {error_message}。可能 nonce 失效，正在尝试刷新并重试...")
+            
+            nonce = await self._get_nonce(force_refresh=True)
+            payload['nonce'] = nonce
+            
+            response = await self._request("POST", settings.UPSTREAM_URL, data=payload, timeout=settings.API_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            response_data = orjson.loads(response.content)
+
+            if not response_data.get("success"):
+                 raise HTTPException(status_code=502, detail=f"重试后上游请求依然失败: {response_data.get('data', '未知错误')}")
+
+        return response_data.get("data", {}).get("message", "")
+
     def _prepare_payload(self, prompt: str, model: str, session_id: str, nonce: str) -> Dict[str, Any]:
         # 映射到上游接受的模型名称
-        if model == "kimi-k2-instruct-0905":
-            upstream_model = "moonshotai/Kimi-K2-Instruct-0905"
-        elif model == "kimi-k2-instruct":
-            upstream_model = "moonshotai/Kimi-K2-Instruct"
-        else:
+        upstream_model = UPSTREAM_MODEL_MAP.get(model)
+        if upstream_model is None:
             raise HTTPException(status_code=400, detail=f"不支持的模型: {model}")
 
         return {
@@ -210,12 +377,5 @@ class KimiAIProvider(BaseProvider):
             "session_id": session_id
         }
 
-    async def get_models(self) -> JSONResponse:
-        model_data = {
-            "object": "list",
-            "data": [
-                {"id": name, "object": "model", "created": int(time.time()), "owned_by": "lzA6"}
-                for name in settings.KNOWN_MODELS
-            ]
-        }
-        return JSONResponse(content=model_data)
+    async def get_models(self) -> Response:
+        return Response(content=self._models_response_bytes, media_type="application/json")
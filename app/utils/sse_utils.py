@@ -1,22 +1,41 @@
-import json
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
+
+import orjson
 
 DONE_CHUNK = b"data: [DONE]\n\n"
 
 def create_sse_data(data: Dict[str, Any]) -> bytes:
     """将字典数据格式化为 SSE 事件字符串。"""
-    return f"data: {json.dumps(data)}\n\n".encode('utf-8')
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def create_content_chunk_affixes(request_id: str, model: str) -> Tuple[bytes, bytes]:
+    """
+    预先生成内容块 SSE 事件中固定不变的前缀与后缀。
+    每个块只需 `prefix + orjson.dumps(content) + suffix`，无需重复构建与序列化整个字典。
+    """
+    prefix = (
+        b'data: {"id":' + orjson.dumps(request_id)
+        + b',"object":"chat.completion.chunk","created":' + str(int(time.time())).encode()
+        + b',"model":' + orjson.dumps(model)
+        + b',"choices":[{"index":0,"delta":{"content":'
+    )
+    suffix = b'},"finish_reason":null}]}\n\n'
+    return prefix, suffix
 
 def create_chat_completion_chunk(
     request_id: str,
     model: str,
     content: str,
-    finish_reason: Optional[str] = None
+    finish_reason: Optional[str] = None,
+    role: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     创建一个与 OpenAI 兼容的聊天补全流式块。
     """
+    delta: Dict[str, Any] = {"content": content}
+    if role:
+        delta["role"] = role
     return {
         "id": request_id,
         "object": "chat.completion.chunk",
@@ -25,7 +44,7 @@ def create_chat_completion_chunk(
         "choices": [
             {
                 "index": 0,
-                "delta": {"content": content},
+                "delta": delta,
                 "finish_reason": finish_reason
             }
         ]
@@ -24,6 +24,7 @@ async def lifespan(app: FastAPI):
     logger.info("服务已进入 'Cloudscraper & Stateful Context' 模式。")
     logger.info(f"服务将在 http://localhost:{settings.NGINX_PORT} 上可用")
     yield
+    await provider.shutdown()
     logger.info("应用关闭。")
 
 app = FastAPI(